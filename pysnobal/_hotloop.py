@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+_hotloop: the jitted per-step glue shared by the pysnobal drivers
+
+The kernels here run once per time step on whole grids and are
+compiled with numba when it is installed, with plain numpy fallbacks
+otherwise. cache=True keeps the compiled kernels on disk so a run
+does not pay the compile cost at startup.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# freezing point of water in K, must match ipysnobal.FREEZE
+FREEZE = 273.16
+
+
+if njit is not None:
+    # fuse the three temperature conversions of get_timestep into one
+    # threaded pass over the grids instead of three separate ones
+    @njit(parallel=True, cache=True)
+    def to_kelvin(T_a, T_pp, T_g):
+        for i in prange(T_a.shape[0]):
+            for j in range(T_a.shape[1]):
+                T_a[i, j] += FREEZE
+                T_pp[i, j] += FREEZE
+                T_g[i, j] += FREEZE
+
+    # same for the smrf queue loop, where the constant ground
+    # temperature is filled once outside the time loop
+    @njit(parallel=True, cache=True)
+    def prep_temps(T_a, T_pp):
+        for i in prange(T_a.shape[0]):
+            for j in range(T_a.shape[1]):
+                T_a[i, j] += FREEZE
+                T_pp[i, j] += FREEZE
+else:
+    def to_kelvin(T_a, T_pp, T_g):
+        T_a += FREEZE
+        T_pp += FREEZE
+        T_g += FREEZE
+
+    def prep_temps(T_a, T_pp):
+        T_a += FREEZE
+        T_pp += FREEZE
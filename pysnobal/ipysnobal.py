@@ -9,24 +9,31 @@ interpretation
 20160118 Scott Havens
 """
 
-from .c_snobal import snobal
 import os
+
+# keep the OpenMP threads of the pixel loop pinned to cores; libgomp
+# reads these when the extension is loaded, so set them first
+os.environ.setdefault('OMP_PROC_BIND', 'close')
+os.environ.setdefault('OMP_PLACES', 'cores')
+
+from .c_snobal import snobal
 import configparser
 import sys
-import os
 import numpy as np
 import pandas as pd
 from datetime import timedelta
 import netCDF4 as nc
 # import matplotlib.pyplot as plt
 # import progressbar
-from copy import copy
 
 try:
     from Queue import Queue, Empty, Full
 except:
     from queue import Queue, Empty, Full
+
+from ._hotloop import to_kelvin as _to_kelvin, prep_temps as _prep_temps
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from time import time as _time
 import logging
 # from multiprocessing import Pool
@@ -53,6 +60,35 @@ DEFAULT_SMALL_TSTEP = 1.0
 WHOLE_TSTEP = 0x1  # output when tstep is not divided
 DIVIDED_TSTEP = 0x2  # output when timestep is divided
 
+# upper bound on the output time steps buffered in memory before they
+# are written to the netCDF files in one contiguous block, and the
+# byte budget the default depth is derived from on large grids
+OUTPUT_BUFFER_STEPS = 64
+OUTPUT_BUFFER_BYTES = 512 << 20
+
+# map from the forcing file names to the values required by snobal
+MAP_VAL = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
+           'vapor_pressure': 'e_a', 'wind_speed': 'u',
+           'soil_temp': 'T_g', 'precip_mass': 'm_pp',
+           'percent_snow': 'percent_snow', 'snow_density': 'rho_snow',
+           'precip_temp': 'T_pp'}
+
+# forcing variables passed to do_tstep_grid, in their slot order
+# within the persistent input buffers
+INPUT_VARS = ('T_a', 'S_n', 'I_lw', 'e_a', 'u', 'T_g',
+              'm_pp', 'percent_snow', 'rho_snow', 'T_pp')
+
+# one line of the point output file, formatted and written in a
+# single call per time step
+POINT_OUT_FMT = ('%g,'
+                 '%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,'
+                 '%.3f,%.3f,'
+                 '%.9e,%.9e,%.9e,'
+                 '%.8f,%.8f,%.8f,'
+                 '%.6f,%.6f,%.6f,%.3f,'
+                 '%.3f,%.3f,%.3f,%.3f,'
+                 '%.5f,%.5f,%.5f\n')
+
 
 def hrs2min(x): return x * 60
 def min2sec(x): return x * 60
@@ -71,31 +107,19 @@ def K_TO_C(x): return x - FREEZE
 # parse configuration file
 class MyParser(configparser.ConfigParser):
     def as_dict(self):
-        d = dict(self._sections)
-        for k in d:
-            d[k] = dict(self._defaults, **d[k])
-            d[k].pop('__name__', None)
-        d = self._make_lowercase(d)
-        return d
+        # items() already merges in the defaults, so no manual merge
+        # with the private _sections/_defaults attributes is needed
+        d = {s: dict(self.items(s)) for s in self.sections()}
+        return self._make_lowercase(d)
 
     def _make_lowercase(self, obj):
-        if hasattr(obj, 'iteritems'):
-            # dictionary
-            ret = {}
-            for k, v in obj.iteritems():
-                ret[self._make_lowercase(k)] = v
-            return ret
-        elif isinstance(obj, basestring):
-            # string
-            return obj.lower()
-        elif hasattr(obj, '__iter__'):
-            # list (or the like)
-            ret = []
-            for item in obj:
-                ret.append(self._make_lowercase(item))
-            return ret
+        # only the section names and keys are lowered, the values pass
+        # through untouched since they hold case-sensitive file paths
+        if isinstance(obj, dict):
+            return {k.lower() if isinstance(k, str) else k:
+                    self._make_lowercase(v)
+                    for k, v in obj.items()}
         else:
-            # anything else
             return obj
 
 
@@ -121,12 +145,12 @@ def date_range(start_date, end_date, increment):
     Calculate a list between start and end date with
     an increment
     '''
-    result = []
-    nxt = start_date
-    while nxt <= end_date:
-        result.append(nxt)
-        nxt += increment
-    return np.array(result)
+    # compute the number of steps once and build the whole vector with
+    # a single arange instead of appending one datetime at a time
+    n = int((end_date - start_date) / increment) + 1
+    step = np.timedelta64(int(increment.total_seconds()), 's')
+    dv = np.datetime64(start_date, 'ns') + np.arange(n) * step
+    return pd.to_datetime(dv)
 
 
 def get_args(configFile):
@@ -215,9 +239,12 @@ def get_args(configFile):
         end_date = pd.to_datetime(config['time']['end_date'])
         if end_date < start_date:
             raise ValueError('end_date is before start_date')
-        nsteps = (end_date-start_date).total_seconds() / \
-            60  # elapsed time in minutes
-        nsteps = int(nsteps / config['time']['time_step'])
+
+        # number of elapsed steps with integer datetime64 arithmetic,
+        # the same arithmetic date_range uses to build the vector
+        step64 = np.timedelta64(config['time']['time_step'] * 60, 's')
+        nsteps = int((np.datetime64(end_date, 's') -
+                      np.datetime64(start_date, 's')) // step64)
 
     elif 'nsteps' in config['time']:
         nsteps = int(config['time']['nsteps'])
@@ -267,6 +294,21 @@ def get_args(configFile):
     except:
         config['output']['nthreads'] = None
 
+    # chunking and compression for the output netCDF files
+    config['output']['netcdf_chunk_bytes'] = int(
+        config['output'].get('netcdf_chunk_bytes', 1 << 20))
+    config['output']['netcdf_chunk_prefer_time'] = str(
+        config['output'].get('netcdf_chunk_prefer_time',
+                             'true')).lower() == 'true'
+    config['output']['netcdf_complevel'] = int(
+        config['output'].get('netcdf_complevel', 4))
+
+    # number of output time steps staged in memory between writes,
+    # sized to the grid in output_files when not set explicitly
+    buffer_steps = config['output'].get('buffer_steps')
+    config['output']['buffer_steps'] = \
+        int(buffer_steps) if buffer_steps is not None else None
+
     return config, point_run
 
 
@@ -340,7 +382,10 @@ def get_tstep_info(options, config):
 #     params['pr_filename'] = options['p']
     params['out_filename'] = config['output']['out_filename']
     if params['out_filename'] is not None:
-        params['out_file'] = open(params['out_filename'], 'w')
+        # large userspace buffer so the per-step line writes rarely
+        # hit the OS
+        params['out_file'] = open(params['out_filename'], 'w',
+                                  buffering=1 << 20)
     params['stop_no_snow'] = options['c']
     params['temps_in_C'] = options['K']
     params['relative_heights'] = options['relative_heights']
@@ -363,32 +408,31 @@ def open_files(options):
     # ------------------------------------------------------------------------------
     # get the initial conditions
     i = nc.Dataset(options['initial_conditions']['file'])
+    i.set_auto_mask(False)
 
-    # read the required variables in
+    # read the required variables in as float64 so no second pass
+    # over the arrays is needed
     init = {}
-    init['x'] = i.variables['x'][:]         # get the x coordinates
-    init['y'] = i.variables['y'][:]         # get the y coordinates
-    init['elevation'] = i.variables['z'][:]         # get the elevation
-    init['z_0'] = i.variables['z_0'][:]     # get the roughness length
+    init['x'] = np.asarray(i.variables['x'][:], dtype=np.float64)
+    init['y'] = np.asarray(i.variables['y'][:], dtype=np.float64)
+    init['elevation'] = np.asarray(i.variables['z'][:], dtype=np.float64)
+    init['z_0'] = np.asarray(i.variables['z_0'][:], dtype=np.float64)
 
     # All other variables will be assumed zero if not present
-    all_zeros = np.zeros_like(init['elevation'])
     flds = ['z_s', 'rho', 'T_s_0', 'T_s', 'h2o_sat', 'mask']
 
     for f in flds:
-        if i.variables.has_key(f):
-            init[f] = i.variables[f][:]         # read in the variables
+        if f in i.variables:
+            init[f] = np.asarray(i.variables[f][:], dtype=np.float64)
         elif f == 'mask':
             # if no mask set all to ones so all will be ran
             init[f] = np.ones_like(init['elevation'])
         else:
-            init[f] = all_zeros                 # default is set to zeros
+            # a fresh array per field so none of them alias each other
+            init[f] = np.zeros_like(init['elevation'])
 
     i.close()
 
-    for key in init.keys():
-        init[key] = init[key].astype(np.float64)
-
     # convert temperatures to K
     init['T_s'] += FREEZE
     init['T_s_0'] += FREEZE
@@ -419,23 +463,198 @@ def open_files(options):
     # print os.stat(options['inputs']['precip_temp']).st_size
     # print force['precip_mass']['precip_mass'][950:960,:,:]
 
-    return init, force
+    # the forcing data is read every time step, turn off the automatic
+    # masking so each read returns a plain ndarray instead of
+    # allocating a masked-array wrapper and scanning for fill values.
+    # Scaling is only skipped for files that carry no packing
+    # attributes, a packed variable still needs scale_factor and
+    # add_offset applied on read
+    for f, ds in force.items():
+        if not isinstance(ds, np.ndarray):
+            ds.set_auto_mask(False)
+            ds.set_always_mask(False)
+            packed = any(
+                hasattr(v, 'scale_factor') or hasattr(v, 'add_offset')
+                for v in ds.variables.values())
+            if not packed:
+                ds.set_auto_scale(False)
+
+    # decode the time variable of each forcing file once so that the
+    # run loop doesn't call nc.date2index for every variable at every
+    # time step, which re-parses the calendar metadata each call.
+    # Keep the numeric time values, units and calendar around as well
+    # for a sorted search when a time step isn't in the map
+    time_index = {}
+    for f, ds in force.items():
+        if isinstance(ds, np.ndarray):
+            continue
+        t = ds.variables['time']
+        times = nc.num2date(t[:], t.units, t.calendar,
+                            only_use_cftime_datetimes=False,
+                            only_use_python_datetimes=True)
+        time_index[f] = {
+            'index': {pd.Timestamp(tm): i for i, tm in enumerate(times)},
+            'numeric': np.asarray(t[:]),
+            'units': t.units,
+            'calendar': t.calendar,
+            # resolve the data variable name once instead of a set
+            # difference per variable per time step
+            'data_var': list(set(ds.variables.keys()) -
+                             set(ds.dimensions.keys()))[0],
+        }
+
+    return init, force, time_index
+
+
+class ForcingCache:
+    """
+    Windowed read-ahead cache for the forcing netCDF files
+
+    Reads a block of time steps per variable into a numpy buffer and
+    serves the individual time slices from memory, so the HDF5 chunks
+    are read and decompressed once per block instead of once per
+    model time step
+    """
+
+    def __init__(self, force, window=None):
+        """
+        Args:
+            force: dict of open nc.Dataset from open_files
+            window: number of time steps to read per block, defaults
+                to the time chunk size of each file
+        """
+        self.force = force
+        self.window = window
+        self._buf = {}      # f -> (t_lo, t_hi, ndarray)
+        self._var = {}      # f -> name of the data variable
+        self._scratch = {}  # f -> two persistent output grids
+        self._slot = {}     # f -> scratch grid used last
+
+    def _data_var(self, f):
+        if f not in self._var:
+            ds = self.force[f]
+            self._var[f] = list(set(ds.variables.keys()) -
+                                set(ds.dimensions.keys()))[0]
+        return self._var[f]
+
+    def get(self, f, t, out=None):
+        """
+        Return the full grid for forcing file f at time index t,
+        copied into out when an array is given
+        """
+        buf = self._buf.get(f)
+
+        if buf is None or not (buf[0] <= t < buf[1]):
+            var = self.force[f].variables[self._data_var(f)]
+
+            k = self.window
+            if k is None:
+                # match the read window to the file's chunking so a
+                # block read touches each HDF5 chunk only once
+                chunking = var.chunking()
+                k = chunking[0] if isinstance(chunking, list) else 1
+            k = max(int(k), 1)
+
+            t_hi = min(t + k, var.shape[0])
+            # the forcings are held in float32, half the memory and
+            # bandwidth of float64; the snobal call converts to the
+            # float64 it needs once per step either way
+            buf = (t, t_hi, np.asarray(var[t:t_hi, :], dtype=np.float32))
+            self._buf[f] = buf
+
+        # with a caller-provided destination, copy the slice straight
+        # into it and skip the scratch grids entirely
+        if out is not None:
+            np.copyto(out, buf[2][t - buf[0]])
+            return out
+
+        # copy the slice into one of two persistent scratch grids,
+        # alternating between them since the caller keeps the previous
+        # step's arrays alive. This avoids a fresh allocation per read
+        # and keeps in-place edits by the caller out of the cache block
+        scratch = self._scratch.get(f)
+        if scratch is None:
+            shape = buf[2].shape[1:]
+            scratch = (np.empty(shape, dtype=buf[2].dtype),
+                       np.empty(shape, dtype=buf[2].dtype))
+            self._scratch[f] = scratch
+
+        slot = self._slot[f] = 1 - self._slot.get(f, 1)
+        out = scratch[slot]
+        np.copyto(out, buf[2][t - buf[0]])
+        return out
 
 
 def close_files(force):
 
-    for f in force.keys():
+    for f in force:
         if not isinstance(force[f], np.ndarray):
             force[f].close()
 
 
+def output_chunk_sizes(ny, nx, target_bytes=1 << 20, prefer_time=True,
+                       buffer_steps=OUTPUT_BUFFER_STEPS):
+    """
+    Pick the netCDF chunk sizes for a (time, y, x) float32 variable
+
+    Chunks are sized toward target_bytes and extended along the time
+    dimension when prefer_time is True, which matches both how the
+    model writes (whole grids over many time steps) and how the output
+    is usually read back (time series at a point or small region)
+
+    Args:
+        ny: number of rows in the grid
+        nx: number of columns in the grid
+        target_bytes: approximate size of one chunk in bytes
+        prefer_time: extend chunks along time instead of one full
+            grid per chunk
+        buffer_steps: depth of the output staging buffers, chunks
+            are never deeper than one flushed block
+
+    Returns:
+        tuple of chunk sizes for the (time, y, x) dimensions
+    """
+
+    if prefer_time:
+        cy = min(ny, 128)
+        cx = min(nx, 128)
+        ct = max(1, target_bytes // (4 * cy * cx))
+        ct = min(ct, buffer_steps)
+    else:
+        # one whole grid per chunk
+        ct = 1
+        cy = ny
+        cx = nx
+
+    return (int(ct), int(cy), int(cx))
+
+
 def output_files(options, init):
     """
     Create the snow and em output netCDF file
     """
 
-    # chunk size
-    cs = (6, 10, 10)
+    # chunk sizes and compression for the output variables, sized to
+    # the grid instead of a hard-coded (6, 10, 10)
+    ny = len(init['y'])
+    nx = len(init['x'])
+
+    # default staging depth sized to the grid so the buffers stay
+    # within OUTPUT_BUFFER_BYTES: two sets of 19 float32 variables
+    # (10 em + 9 snow) per buffered time step
+    K = options['output']['buffer_steps']
+    if K is None:
+        per_step = 2 * 19 * 4 * ny * nx
+        K = int(max(1, min(OUTPUT_BUFFER_STEPS,
+                           OUTPUT_BUFFER_BYTES // per_step)))
+        options['output']['buffer_steps'] = K
+
+    cs = output_chunk_sizes(
+        ny, nx,
+        target_bytes=options['output']['netcdf_chunk_bytes'],
+        prefer_time=options['output']['netcdf_chunk_prefer_time'],
+        buffer_steps=K)
+    complevel = options['output']['netcdf_complevel']
 
     # ------------------------------------------------------------------------------
     # EM netCDF
@@ -452,6 +671,7 @@ def output_files(options, init):
     dimensions = ('time', 'y', 'x')
 
     em = nc.Dataset(netcdfFile, 'w')
+    em.set_auto_mask(False)
 
     # create the dimensions
     em.createDimension('time', None)
@@ -473,8 +693,8 @@ def output_files(options, init):
     # em image
     for i, v in enumerate(m['name']):
 
-        #         em.createVariable(v, 'f', dimensions[:3], chunksizes=(6,10,10))
-        em.createVariable(v, 'f', dimensions[:3], chunksizes=cs)
+        em.createVariable(v, 'f', dimensions[:3], chunksizes=cs,
+                          zlib=True, complevel=complevel, shuffle=True)
         setattr(em.variables[v], 'units', m['units'][i])
         setattr(em.variables[v], 'description', m['description'][i])
 
@@ -496,6 +716,7 @@ def output_files(options, init):
     dimensions = ('time', 'y', 'x')
 
     snow = nc.Dataset(netcdfFile, 'w')
+    snow.set_auto_mask(False)
 
     # create the dimensions
     snow.createDimension('time', None)
@@ -517,17 +738,91 @@ def output_files(options, init):
     # snow image
     for i, v in enumerate(s['name']):
 
-        snow.createVariable(v, 'f', dimensions[:3], chunksizes=cs)
-#         snow.createVariable(v, 'f', dimensions[:3])
+        snow.createVariable(v, 'f', dimensions[:3], chunksizes=cs,
+                            zlib=True, complevel=complevel, shuffle=True)
         setattr(snow.variables[v], 'units', s['units'][i])
         setattr(snow.variables[v], 'description', s['description'][i])
 
     options['output']['snow'] = snow
 
+    # two sets of staging buffers, written to disk in blocks of
+    # buffer_steps time steps. A flushed set is written in the
+    # background while the model keeps filling the other one
+    options['output']['em_buffer'] = [
+        {v: np.empty((K, ny, nx), dtype='f4') for v in m['name']}
+        for _ in range(2)]
+    options['output']['snow_buffer'] = [
+        {v: np.empty((K, ny, nx), dtype='f4') for v in s['name']}
+        for _ in range(2)]
+    options['output']['time_buffer'] = [np.empty(K), np.empty(K)]
+    options['output']['buffer_set'] = 0
+    options['output']['buffer_count'] = 0
+    options['output']['pending'] = []
+
+    # number of time steps already written to the files
+    options['output']['step'] = 0
+
+    # keep the time encoding out of the Datasets so the model thread
+    # never touches them while a flush is being written
+    options['output']['time_units'] = 'hours since %s' % \
+        options['time']['start_date']
+    options['output']['time_calendar'] = 'standard'
+
+    # one thread per output file, the writes to the two files are
+    # independent and netCDF4 releases the GIL during them
+    options['output']['writer'] = ThreadPoolExecutor(max_workers=2)
+
+
+def flush_output_buffers(options):
+    """
+    Hand the staged output time steps to the writer pool as one
+    contiguous block per variable and switch to the other staging set,
+    so the model keeps running while the block is written and synced
+    """
+
+    out = options['output']
+    n = out['buffer_count']
+    if n == 0:
+        return
 
-def output_timestep(s, tstep, options):
+    em = out['em']
+    snow = out['snow']
+    cur = out['buffer_set']
+
+    # only one flush may be in flight against the files, so wait out
+    # the previous one (it had a whole buffer's worth of steps to
+    # finish) before submitting this set
+    for fut in out['pending']:
+        fut.result()
+
+    # index of the first buffered time step, tracked as a counter so
+    # the file's time variable is never read back to find it
+    index = out['step']
+    time_buffer = out['time_buffer'][cur]
+
+    def write(ds, buffers):
+        ds.variables['time'][index:index+n] = time_buffer[:n]
+        for key, buf in buffers.items():
+            ds.variables[key][index:index+n, :] = buf[:n]
+        ds.sync()
+
+    # the two files are independent, write them concurrently
+    out['pending'] = [out['writer'].submit(write, em, out['em_buffer'][cur]),
+                      out['writer'].submit(write, snow,
+                                           out['snow_buffer'][cur])]
+
+    out['buffer_set'] = 1 - cur
+    out['step'] = index + n
+    out['buffer_count'] = 0
+
+
+def output_timestep(s, tstep, options, active=None):
     """
     Output the model results for the current time step
+
+    When the state is compacted to the active cells, active holds
+    their flat indices and the fields are scattered back onto the
+    full grid on the way into the staging buffers
     """
 
     em_out = {'net_rad': 'R_n_bar', 'sensible_heat': 'H_bar', 'latent_heat': 'L_v_E_bar',
@@ -541,55 +836,47 @@ def output_timestep(s, tstep, options):
                 'temp_snowcover': 'T_s', 'thickness_lower': 'z_s_l',
                 'water_saturation': 'h2o_sat'}
 
-    # preallocate
-#     all_zeros = np.zeros(s['elevation'].shape)
-#     em = {key: all_zeros for key in em_out.keys()}
-#     snow = {key: all_zeros for key in snow_out.keys()}
-    em = {}
-    snow = {}
+    # the three temperatures are converted from K to C on the way
+    # into the buffer
+    temp_fields = ('temp_surf', 'temp_lower', 'temp_snowcover')
 
-    # gather all the data together
-#     for index, si in np.ndenumerate(s):
-#
-#         if si is not None:
-    for key, value in em_out.iteritems():
-        em[key] = copy(s[value])
-
-    for key, value in snow_out.iteritems():
-        snow[key] = copy(s[value])
-
-    # convert from K to C
-    snow['temp_snowcover'] -= FREEZE
-    snow['temp_surf'] -= FREEZE
-    snow['temp_lower'] -= FREEZE
-
-    # now find the correct index
-    # the current time integer
-    times = options['output']['snow'].variables['time']
-    t = nc.date2num(tstep.replace(tzinfo=None), times.units, times.calendar)
-
-    if len(times) != 0:
-        index = np.where(times[:] == t)[0]
-        if index.size == 0:
-            index = len(times)
-        else:
-            index = index[0]
-    else:
-        index = len(times)
+    out = options['output']
 
-    # insert the time
-    options['output']['snow'].variables['time'][index] = t
-    options['output']['em'].variables['time'][index] = t
+    # the current time integer, encoded with the cached units and
+    # calendar so the open Datasets are left to the writer pool
+    t = nc.date2num(tstep.replace(tzinfo=None), out['time_units'],
+                    out['time_calendar'])
 
-    # insert the data
-    for key in em_out:
-        options['output']['em'].variables[key][index, :] = em[key]
-    for key in snow_out:
-        options['output']['snow'].variables[key][index, :] = snow[key]
+    # gather all the data together, straight into the staging buffers
+    # so no intermediate full-grid copies are made
+    cur = out['buffer_set']
+    em_buffer = out['em_buffer'][cur]
+    snow_buffer = out['snow_buffer'][cur]
+    i = out['buffer_count']
+    out['time_buffer'][cur][i] = t
 
-    # sync to disk
-    options['output']['snow'].sync()
-    options['output']['em'].sync()
+    for key, value in em_out.items():
+        if active is None:
+            em_buffer[key][i] = s[value]
+        else:
+            buf = em_buffer[key][i].reshape(-1)
+            buf.fill(0)
+            buf[active] = s[value].ravel()
+
+    for key, value in snow_out.items():
+        data = s[value] - FREEZE if key in temp_fields else s[value]
+        if active is None:
+            snow_buffer[key][i] = data
+        else:
+            buf = snow_buffer[key][i].reshape(-1)
+            buf.fill(0)
+            buf[active] = data.ravel()
+
+    out['buffer_count'] = i + 1
+
+    # hand off to the writer once the staging set is full
+    if out['buffer_count'] == len(out['time_buffer'][cur]):
+        flush_output_buffers(options)
 
 
 def output_timestep_point(output_rec, params):
@@ -608,7 +895,9 @@ def output_timestep_point(output_rec, params):
     n = 0  # np.unravel_index(0, output_rec['elevation'])
     if f is not None:
 
-        curr_time_hrs = SEC_TO_HR(output_rec['current_time'][n])
+        # index down to python scalars, %-formatting a length-1 array
+        # raises on newer numpy
+        curr_time_hrs = SEC_TO_HR(output_rec['current_time'][n, 0])
 
 #         # time
 #         f.write('%g,' % curr_time_hrs)
@@ -640,95 +929,121 @@ def output_timestep_point(output_rec, params):
 #             f.write("%.2f,%.2f,%.2f\n" % \
 #                     (output_rec['T_s_0'][n], output_rec['T_s_l'][n], output_rec['T_s'][n]))
 
-        # time
-        f.write('%g,' % curr_time_hrs)
-
-        # energy budget terms
-        f.write("%.3f,%.3f,%.3f,%.3f,%.3f,%.3f," %
-                (output_rec['R_n_bar'][n], output_rec['H_bar'][n], output_rec['L_v_E_bar'][n],
-                 output_rec['G_bar'][n], output_rec['M_bar'][n], output_rec['delta_Q_bar'][n]))
-
-        # layer terms
-        f.write("%.3f,%.3f," %
-                (output_rec['G_0_bar'][n], output_rec['delta_Q_0_bar'][n]))
-
-        # heat storage and mass changes
-        f.write("%.9e,%.9e,%.9e," %
-                (output_rec['cc_s_0'][n], output_rec['cc_s_l'][n], output_rec['cc_s'][n]))
-        f.write("%.8f,%.8f,%.8f," %
-                (output_rec['E_s_sum'][n], output_rec['melt_sum'][n], output_rec['ro_pred_sum'][n]))
+        if params['temps_in_C']:
+            T_s_0 = K_TO_C(output_rec['T_s_0'][n, 0])
+            T_s_l = K_TO_C(output_rec['T_s_l'][n, 0])
+            T_s = K_TO_C(output_rec['T_s'][n, 0])
+        else:
+            T_s_0 = output_rec['T_s_0'][n, 0]
+            T_s_l = output_rec['T_s_l'][n, 0]
+            T_s = output_rec['T_s'][n, 0]
 
         #             # runoff error if data included */
         #             if (ro_data)
         #                 fprintf(out, " %.3f",
         #                         (ro_pred_sum - (ro * time_since_out)))
 
-        # sno properties */
-        f.write("%.6f,%.6f,%.6f,%.3f," %
-                (output_rec['z_s_0'][n], output_rec['z_s_l'][n], output_rec['z_s'][n], output_rec['rho'][n]))
-        f.write("%.3f,%.3f,%.3f,%.3f," %
-                (output_rec['m_s_0'][n], output_rec['m_s_l'][n], output_rec['m_s'][n], output_rec['h2o'][n]))
-        if params['temps_in_C']:
-            f.write("%.5f,%.5f,%.5f\n" %
-                    (K_TO_C(output_rec['T_s_0'][n]), K_TO_C(output_rec['T_s_l'][n]), K_TO_C(output_rec['T_s'][n])))
-        else:
-            f.write("%.5f,%.5f,%.5f\n" %
-                    (output_rec['T_s_0'][n], output_rec['T_s_l'][n], output_rec['T_s'][n]))
+        # time, energy budget terms, layer terms, heat storage and
+        # mass changes, then snow properties in one formatted write
+        # instead of eight
+        f.write(POINT_OUT_FMT % (
+            curr_time_hrs,
+            output_rec['R_n_bar'][n, 0], output_rec['H_bar'][n, 0],
+            output_rec['L_v_E_bar'][n, 0], output_rec['G_bar'][n, 0],
+            output_rec['M_bar'][n, 0], output_rec['delta_Q_bar'][n, 0],
+            output_rec['G_0_bar'][n, 0], output_rec['delta_Q_0_bar'][n, 0],
+            output_rec['cc_s_0'][n, 0], output_rec['cc_s_l'][n, 0],
+            output_rec['cc_s'][n, 0],
+            output_rec['E_s_sum'][n, 0], output_rec['melt_sum'][n, 0],
+            output_rec['ro_pred_sum'][n, 0],
+            output_rec['z_s_0'][n, 0], output_rec['z_s_l'][n, 0],
+            output_rec['z_s'][n, 0], output_rec['rho'][n, 0],
+            output_rec['m_s_0'][n, 0], output_rec['m_s_l'][n, 0],
+            output_rec['m_s'][n, 0], output_rec['h2o'][n, 0],
+            T_s_0, T_s_l, T_s))
 
         # reset the time since out
         output_rec['time_since_out'][n] = 0
 
 
-def get_timestep(force, tstep, point=None):
+def get_timestep(force, tstep, point=None, time_index=None, cache=None,
+                 out=None):
     """
     Pull out a time step from the forcing files and
     place that time step into a dict
-    """
 
-    inpt = {}
+    When out is one of the persistent input slots from input_buffers,
+    the grids are read into it in place instead of binding fresh
+    arrays, so the time loop allocates nothing
+    """
 
-    # map function from these values to the ones requried by snobal
-    map_val = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
-               'vapor_pressure': 'e_a', 'wind_speed': 'u',
-               'soil_temp': 'T_g', 'precip_mass': 'm_pp',
-               'percent_snow': 'percent_snow', 'snow_density': 'rho_snow',
-               'precip_temp': 'T_pp'}
+    inpt = {} if out is None else out
 
     for f in force.keys():
 
         if isinstance(force[f], np.ndarray):
             # If it's a constant value then just read in the numpy array
             # pull out the value
-            if point is None:
-                # ensures not a reference (especially if T_g)
-                inpt[map_val[f]] = force[f].copy()
+            if point is not None:
+                inpt[MAP_VAL[f]] = np.atleast_2d(force[f][point[0], point[1]])
+            elif out is not None:
+                inpt[MAP_VAL[f]][:] = force[f]
             else:
-                inpt[map_val[f]] = np.atleast_2d(force[f][point[0], point[1]])
+                # ensures not a reference (especially if T_g)
+                inpt[MAP_VAL[f]] = force[f].copy()
 
         else:
             # determine the index in the netCDF file
 
-            # compare the dimensions and variables to get the variable name
-            v = list(set(force[f].variables.keys()) -
-                     set(force[f].dimensions.keys()))[0]
-
-            # find the index based on the time step
-            t = nc.date2index(tstep, force[f].variables['time'],
-                              calendar=force[f].variables['time'].calendar,
-                              select='exact')
-
-            # pull out the value
-            if point is None:
-                inpt[map_val[f]] = force[f].variables[v][t,
-                                                         :].astype(np.float64)
+            # find the index based on the time step, use the cached
+            # time index from open_files if given
+            if time_index is not None:
+                ti = time_index[f]
+                v = ti['data_var']
+                t = ti['index'].get(tstep)
+                if t is None:
+                    # search the cached numeric time values instead
+                    # of decoding the time variable again, and refuse
+                    # anything but an exact hit like date2index with
+                    # select='exact' did
+                    tnum = nc.date2num(tstep.replace(tzinfo=None),
+                                       ti['units'], ti['calendar'])
+                    t = int(np.searchsorted(ti['numeric'], tnum))
+                    if t >= len(ti['numeric']) or ti['numeric'][t] != tnum:
+                        raise KeyError(
+                            'time step %s not found in %s' % (tstep, f))
             else:
-                inpt[map_val[f]] = np.atleast_2d(
-                    force[f].variables[v][t, point[0], point[1]].astype(np.float64))
+                # compare the dimensions and variables to get the
+                # variable name
+                v = list(set(force[f].variables.keys()) -
+                         set(force[f].dimensions.keys()))[0]
+                t = nc.date2index(tstep, force[f].variables['time'],
+                                  calendar=force[f].variables['time'].calendar,
+                                  select='exact')
+
+            # pull out the value, served from the read-ahead cache
+            # when one is given
+            if point is not None:
+                if cache is not None:
+                    inpt[MAP_VAL[f]] = np.atleast_2d(
+                        cache.get(f, t)[point[0], point[1]])
+                else:
+                    inpt[MAP_VAL[f]] = np.atleast_2d(
+                        force[f].variables[v][t, point[0], point[1]]).astype(
+                            np.float32)
+            elif cache is not None:
+                if out is not None:
+                    cache.get(f, t, out=inpt[MAP_VAL[f]])
+                else:
+                    inpt[MAP_VAL[f]] = cache.get(f, t)
+            elif out is not None:
+                inpt[MAP_VAL[f]][:] = force[f].variables[v][t, :]
+            else:
+                inpt[MAP_VAL[f]] = np.asarray(force[f].variables[v][t, :],
+                                              dtype=np.float32)
 
     # convert from C to K
-    inpt['T_a'] += FREEZE
-    inpt['T_pp'] += FREEZE
-    inpt['T_g'] += FREEZE
+    _to_kelvin(inpt['T_a'], inpt['T_pp'], inpt['T_g'])
 
     return inpt
 
@@ -759,9 +1074,53 @@ def get_timestep(force, tstep, point=None):
 #
 #     return s
 
-def initialize(params, tstep_info, init):
+def compact_grid(inpt, active, out=None):
+    """
+    Gather the active cells of each grid in the dict into a (1, n)
+    array ordered by the flat index active
+
+    With out, the cells are gathered into the given input slot in
+    place so no arrays are allocated
+    """
+    if out is None:
+        return {k: np.ascontiguousarray(v.ravel()[active][np.newaxis, :])
+                for k, v in inpt.items()}
+
+    for k, v in inpt.items():
+        np.take(v.ravel(), active, out=out[k][0])
+    return out
+
+
+def input_buffers(ny, nx, n=2):
+    """
+    Allocate n input slots handed to do_tstep_grid as views into one
+    contiguous (n, n_vars, ny, nx) array
+
+    Keeping all the forcing variables of a time step adjacent in one
+    allocation lets the C side walk them without touching disjoint
+    allocations, and reusing the slots every step removes the
+    per-step array allocations from the time loop. Two slots cover a
+    plain ping-pong; the prefetching driver uses four so the slot
+    being read ahead never aliases the two steps still in use
+    """
+    buf = np.empty((n, len(INPUT_VARS), ny, nx), dtype=np.float64)
+    return tuple({v: buf[i, k] for k, v in enumerate(INPUT_VARS)}
+                 for i in range(n))
+
+
+def initialize(params, tstep_info, init, compact=False):
     """
     initialize
+
+    With compact, the state arrays only hold the active (unmasked)
+    cells as (1, n_active) arrays, so the memory and bandwidth used
+    per time step scale with the number of cells that are actually
+    run instead of the full grid
+
+    Returns:
+        s: the output record dict
+        active: flat indices of the active cells, None when the state
+            is kept on the full grid
     """
 
     # create the OUTPUT_REC with additional fields and fill
@@ -769,24 +1128,43 @@ def initialize(params, tstep_info, init):
     # have due to the output function being outside the C code which doesn't
     # have access to those variables
     sz = init['elevation'].shape
-    flds = ['mask', 'elevation', 'z_0', 'rho', 'T_s_0', 'T_s_l', 'T_s',
-            'cc_s_0', 'cc_s_l', 'cc_s', 'm_s', 'm_s_0', 'm_s_l', 'z_s', 'z_s_0', 'z_s_l',
-            'h2o_sat', 'layer_count', 'h2o', 'h2o_max', 'h2o_vol', 'h2o_total',
-            'R_n_bar', 'H_bar', 'L_v_E_bar', 'G_bar', 'G_0_bar',
-            'M_bar', 'delta_Q_bar', 'delta_Q_0_bar', 'E_s_sum', 'melt_sum', 'ro_pred_sum',
-            'current_time', 'time_since_out']
-    s = {key: np.zeros(sz) for key in flds}  # the structure fields
-
-    # go through each sn value and fill
-    for key, val in init.items():
-        if key in flds:
-            s[key] = val
+    flds = frozenset([
+        'mask', 'elevation', 'z_0', 'rho', 'T_s_0', 'T_s_l', 'T_s',
+        'cc_s_0', 'cc_s_l', 'cc_s', 'm_s', 'm_s_0', 'm_s_l', 'z_s', 'z_s_0', 'z_s_l',
+        'h2o_sat', 'layer_count', 'h2o', 'h2o_max', 'h2o_vol', 'h2o_total',
+        'R_n_bar', 'H_bar', 'L_v_E_bar', 'G_bar', 'G_0_bar',
+        'M_bar', 'delta_Q_bar', 'delta_Q_0_bar', 'E_s_sum', 'melt_sum', 'ro_pred_sum',
+        'current_time', 'time_since_out'])
+
+    active = None
+    if compact:
+        idx = np.flatnonzero(init['mask'].ravel() > 0)
+        if idx.size < init['mask'].size:
+            active = idx
+            sz = (1, idx.size)
+
+    # the structure fields, only zero-filling the ones that init
+    # doesn't already provide
+    s = {}
+    for key in flds:
+        if key in init:
+            if active is not None:
+                s[key] = np.ascontiguousarray(
+                    init[key].ravel()[active][np.newaxis, :])
+            else:
+                s[key] = init[key]
+        else:
+            s[key] = np.zeros(sz)
+
+    if active is not None:
+        # every cell that is carried is active
+        s['mask'] = np.ones(sz)
 
 #     for key, val in mh.items():
 #         if key in flds:
 #             s[key] = val
 
-    return s
+    return s, active
 
 
 def main(configFile):
@@ -804,7 +1182,10 @@ def main(configFile):
     params, tstep_info = get_tstep_info(options['constants'], options)
 
     # open the files and read in data
-    init, force = open_files(options)
+    init, force, time_index = open_files(options)
+
+    # read-ahead cache for the forcing data
+    cache = ForcingCache(force)
 
     point = None
     if point_run:
@@ -818,9 +1199,10 @@ def main(configFile):
             else:
                 init[i] = np.atleast_2d(init[i][point])
 
-    # initialize
+    # initialize, carrying only the active cells for a gridded run
 #     s = initialize(params, tstep_info, options['constants'], init)
-    output_rec = initialize(params, tstep_info, init)
+    output_rec, active = initialize(params, tstep_info, init,
+                                    compact=not point_run)
 
     # create the output files
     if not point_run:
@@ -835,23 +1217,88 @@ def main(configFile):
     start_step = 0  # if restart then it would be higher if this were iSnobal
     step_time = start_step * data_tstep
 
-    output_rec['current_time'] = step_time * \
-        np.ones(output_rec['elevation'].shape)
-    output_rec['time_since_out'] = timeSinceOut * \
-        np.ones(output_rec['elevation'].shape)
+    output_rec['current_time'] = np.full(
+        output_rec['elevation'].shape, step_time)
+    output_rec['time_since_out'] = np.full(
+        output_rec['elevation'].shape, timeSinceOut)
+
+    # the per-pixel snobal calls are independent, so the OpenMP loop
+    # over pixels in the C library scales with the configured threads,
+    # defaulting to all the cores of the machine
+    nthreads = options['output']['nthreads']
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+
+    # persistent input slots in one SoA allocation, filled round-robin
+    # so the two steps in use stay intact while the prefetch thread
+    # reads ahead into a third, plus compact slots to gather the
+    # active cells into
+    input_slot = (None,) * 4
+    compact_slot = (None,) * 4
+    if not point_run:
+        input_slot = input_buffers(*init['elevation'].shape, n=4)
+        if active is not None:
+            compact_slot = input_buffers(1, active.size, n=4)
 
-    input1 = get_timestep(force, options['time']['date_time'][0], point)
+    input1 = get_timestep(force, options['time']['date_time'][0],
+                          point, time_index, cache, out=input_slot[0])
+    if active is not None:
+        input1 = compact_grid(input1, active, out=compact_slot[0])
 
 #     if point_run:
 #         input1 = {i: np.atleast_2d(input1[i][point]) for i in input1.keys()}
 
-    # pbar = progressbar.ProgressBar(max_value=len(options['time']['date_time']))
-    j = 1
+    # hoist the loop invariants out of the time loop
+    date_time = options['time']['date_time']
+    n_steps = len(date_time)
+    freq = options['output']['frequency']
+
+    # read and prepare the next time step on a prefetch thread while
+    # the C library runs the current one. One read in flight plus the
+    # two steps in use never exceeds the four slots
+    prefetch_q = Queue(maxsize=1)
+    stop_prefetch = threading.Event()
+
+    def handover(item):
+        # bounded put so the thread can be told to stop while the
+        # consumer is no longer draining the queue
+        while not stop_prefetch.is_set():
+            try:
+                prefetch_q.put(item, timeout=0.1)
+                break
+            except Full:
+                pass
+
+    def prefetch():
+        try:
+            for k, t in enumerate(date_time[1:], start=1):
+                if stop_prefetch.is_set():
+                    return
+                inpt = get_timestep(force, t, point, time_index, cache,
+                                    out=input_slot[k % 4])
+                if active is not None:
+                    inpt = compact_grid(inpt, active,
+                                        out=compact_slot[k % 4])
+                handover(inpt)
+        except Exception as e:
+            # hand the failure to the time loop, which re-raises it,
+            # instead of dying here and leaving the loop blocked on
+            # an empty queue
+            handover(e)
+
+    reader = threading.Thread(target=prefetch, daemon=True)
+    reader.start()
+
+    # pbar = progressbar.ProgressBar(max_value=n_steps)
     first_step = 1
-    for tstep in options['time']['date_time'][1:]:
-        # for tstep in options['time']['date_time'][953:958]:
-
-        input2 = get_timestep(force, tstep, point)
+    for j, tstep in enumerate(date_time[1:], start=1):
+        # for tstep in date_time[953:958]:
+
+        input2 = prefetch_q.get()
+        if isinstance(input2, Exception):
+            # the prefetch thread failed, raise here as the
+            # synchronous reads used to
+            raise input2
         # print output_rec
 
         # this should replicate a Snobal point run but will not mimic the iSnobal results at the point
@@ -861,31 +1308,49 @@ def main(configFile):
                 first_step = 1
 
         rt = snobal.do_tstep_grid(input1, input2, output_rec, tstep_info,
-                                  options['constants'], params, first_step, nthreads=4)
+                                  options['constants'], params, first_step,
+                                  nthreads=nthreads)
         #rt = snobal.do_tstep_grid(input1, input2, output_rec, tstep_info, options['constants'], params, first_step, nthreads=1)
 
         if rt != -1:
             print('ipysnobal error on time step %s, pixel %i' % (tstep, rt))
             break
 
-        input1 = input2.copy()
+        # the slots alternate, so the current step simply becomes the
+        # previous one by rebinding rather than copying
+        input1 = input2
 
         # output at the frequency and the last time step
         if point_run:
             output_timestep_point(output_rec, params)
         else:
-            if (j % options['output']['frequency'] == 0) or (j == len(options['time']['date_time'])):
-                output_timestep(output_rec, tstep, options)
-                output_rec['time_since_out'] = np.zeros(
-                    output_rec['elevation'].shape)
+            if (j % freq == 0) or (j == n_steps):
+                output_timestep(output_rec, tstep, options, active)
+                output_rec['time_since_out'].fill(0.0)
 
-        j += 1
         # pbar.update(j)
 
     # pbar.finish()
 
+    # stop the prefetch thread before the forcing files are closed,
+    # it may still be reading them or blocked handing over a step
+    # after an error break
+    stop_prefetch.set()
+    try:
+        prefetch_q.get_nowait()
+    except Empty:
+        pass
+    reader.join()
+
     # output
 #     params['out_file'].close()
+    if not point_run:
+        flush_output_buffers(options)
+        # shutdown() waits for the last flushed block but never looks
+        # at it, raise here if the write failed
+        for fut in options['output']['pending']:
+            fut.result()
+        options['output']['writer'].shutdown()
     close_files(force)
 #     app = MyApplication()
 #     app.run()
@@ -906,32 +1371,31 @@ def open_init_files(options):
     # ------------------------------------------------------------------------------
     # get the initial conditions
     i = nc.Dataset(options['initial_conditions']['file'])
+    i.set_auto_mask(False)
 
-    # read the required variables in
+    # read the required variables in as float64 directly, so no
+    # second astype pass over the arrays is needed
     init = {}
-    init['x'] = i.variables['x'][:]         # get the x coordinates
-    init['y'] = i.variables['y'][:]         # get the y coordinates
-    init['elevation'] = i.variables['z'][:]         # get the elevation
-    init['z_0'] = i.variables['z_0'][:]     # get the roughness length
+    init['x'] = np.asarray(i.variables['x'][:], dtype=np.float64)
+    init['y'] = np.asarray(i.variables['y'][:], dtype=np.float64)
+    init['elevation'] = np.asarray(i.variables['z'][:], dtype=np.float64)
+    init['z_0'] = np.asarray(i.variables['z_0'][:], dtype=np.float64)
 
     # All other variables will be assumed zero if not present
-    all_zeros = np.zeros_like(init['elevation'])
     flds = ['z_s', 'rho', 'T_s_0', 'T_s', 'h2o_sat', 'mask']
 
     for f in flds:
-        if i.variables.has_key(f):
-            init[f] = i.variables[f][:]         # read in the variables
+        if f in i.variables:
+            init[f] = np.asarray(i.variables[f][:], dtype=np.float64)
         elif f == 'mask':
             # if no mask set all to ones so all will be ran
             init[f] = np.ones_like(init['elevation'])
         else:
-            init[f] = all_zeros                 # default is set to zeros
+            # a fresh array per field so none of them alias each other
+            init[f] = np.zeros_like(init['elevation'])
 
     i.close()
 
-    for key in init.keys():
-        init[key] = init[key].astype(np.float64)
-
     # convert temperatures to K
     init['T_s'] += FREEZE
     init['T_s_0'] += FREEZE
@@ -960,7 +1424,7 @@ def init_from_smrf(configFile):
     # open the files and read in data
     init = open_init_files(options)
 
-    output_rec = initialize(params, tstep_info, init)
+    output_rec, _ = initialize(params, tstep_info, init)
 
     # create the output files
     output_files(options, init)
@@ -1014,15 +1478,21 @@ class QueueIsnobal(threading.Thread):
         # do_data_tstep needs two input records so only go
         # to the last record-1
 
+        # threads for the OpenMP loop over pixels in the C library,
+        # defaulting to all the cores of the machine
+        nthreads = self.options['output']['nthreads']
+        if nthreads is None:
+            nthreads = os.cpu_count() or 1
+
         data_tstep = self.tstep_info[0]['time_step']
         timeSinceOut = 0.0
         start_step = 0  # if restart then it would be higher if this were iSnobal
         step_time = start_step * data_tstep
 
-        self.output_rec['current_time'] = step_time * \
-            np.ones(self.output_rec['elevation'].shape)
-        self.output_rec['time_since_out'] = timeSinceOut * \
-            np.ones(self.output_rec['elevation'].shape)
+        self.output_rec['current_time'] = np.full(
+            self.output_rec['elevation'].shape, step_time)
+        self.output_rec['time_since_out'] = np.full(
+            self.output_rec['elevation'].shape, timeSinceOut)
 
         # map function from these values to the ones requried by snobal
         map_val = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
@@ -1031,83 +1501,107 @@ class QueueIsnobal(threading.Thread):
                    'percent_snow': 'percent_snow', 'snow_density': 'rho_snow',
                    'dew_point': 'T_pp'}
 
+        # two persistent input slots in one SoA allocation, filled
+        # alternately so the previous step's grids stay intact
+        input_slot = input_buffers(self.ny, self.nx)
+
+        # the ground temperature is constant, fill it once in both
+        # slots instead of allocating and converting it every step
+        input_slot[0]['T_g'].fill(-2.5 + FREEZE)
+        input_slot[1]['T_g'].fill(-2.5 + FREEZE)
+
         # get first timestep
-        input1 = {}
+        input1 = input_slot[0]
         for v in force_variables:
-            if v in self.queue.keys():
+            if v in self.queue:
                 # print v
                 data = self.queue[v].get(
                     self.date_time[0], block=True, timeout=None)
+                if v == 'soil_temp':
+                    # the ground temperature is fixed in the slots
+                    # above; consume the queue item but keep the
+                    # constant, as before
+                    continue
                 if data is None:
                     print(v)
                     data = np.zeros((self.ny, self.nx))
                     print('Error of no data from smrf to iSnobal')
-                    input1[map_val[v]] = data
+                    input1[map_val[v]][:] = data
                 else:
-                    input1[map_val[v]] = data
+                    input1[map_val[v]][:] = data
             elif v != 'soil_temp':
                 print('Value not in keys: {}'.format(v))
 
-        # set ground temp
-        input1['T_g'] = -2.5*np.ones((self.ny, self.nx))
-
-        input1['T_a'] += FREEZE
-        input1['T_pp'] += FREEZE
-        input1['T_g'] += FREEZE
+        # convert to K, fused into one pass
+        _prep_temps(input1['T_a'], input1['T_pp'])
 
         # tell queue we assigned all the variables
         self.queue['isnobal'].put([self.date_time[0], True])
         print('Finished initializing first timestep')
 
-        #pbar = progressbar.ProgressBar(max_value=len(options['time']['date_time']))
-        j = 1
+        # hoist the loop invariants out of the time loop, local names
+        # resolve faster than the attribute chains per step
+        n_steps = len(self.options['time']['date_time'])
+        freq = self.options['output']['frequency']
+        queue = self.queue
+        out_rec = self.output_rec
+
+        #pbar = progressbar.ProgressBar(max_value=n_steps)
         first_step = 1
-        for tstep in self.date_time[1:]:
+        for j, tstep in enumerate(self.date_time[1:], start=1):
             # for tstep in options['time']['date_time'][953:958]:
             # get the output variables then pass to the function
             #print('Timestep: {}'.format(tstep))
-            input2 = {}
+            input2 = input_slot[j % 2]
             for v in force_variables:
-                if v in self.queue.keys():
+                if v in queue:
                     # print v
-                    data = self.queue[v].get(tstep, block=True, timeout=None)
+                    data = queue[v].get(tstep, block=True, timeout=None)
+                    if v == 'soil_temp':
+                        # fixed in the slots, see above
+                        continue
                     if data is None:
                         print(v)
                         data = np.zeros((self.ny, self.nx))
                         print('Error of no data from smrf to iSnobal')
-                        input2[map_val[v]] = data
+                        input2[map_val[v]][:] = data
                     else:
-                        input2[map_val[v]] = data
-            # set ground temp
-            input2['T_g'] = -2.5*np.ones((self.ny, self.nx))
-            input2['T_a'] += FREEZE
-            input2['T_pp'] += FREEZE
-            input2['T_g'] += FREEZE
-
-            rt = snobal.do_tstep_grid(input1, input2, self.output_rec,
+                        input2[map_val[v]][:] = data
+            # convert to K, fused into one pass
+            _prep_temps(input2['T_a'], input2['T_pp'])
+
+            rt = snobal.do_tstep_grid(input1, input2, out_rec,
                                       self.tstep_info, self.options['constants'],
-                                      self.params, first_step, nthreads=20)
+                                      self.params, first_step,
+                                      nthreads=nthreads)
 
             if rt != -1:
                 print('ipysnobal error on time step %s, pixel %i' % (tstep, rt))
                 break
 
-            input1 = input2.copy()
+            # the slots alternate, so the current step simply becomes
+            # the previous one by rebinding rather than copying
+            input1 = input2
 
             # output at the frequency and the last time step
-            if (j % self.options['output']['frequency'] == 0) or (j == len(self.options['time']['date_time'])):
-                output_timestep(self.output_rec, tstep, self.options)
-                self.output_rec['time_since_out'] = np.zeros(
-                    self.output_rec['elevation'].shape)
+            if (j % freq == 0) or (j == n_steps):
+                output_timestep(out_rec, tstep, self.options)
+                out_rec['time_since_out'].fill(0.0)
 
-            j += 1
             # pbar.update(j)
 
             # put the value into the output queue so clean knows it's done
-            self.queue['isnobal'].put([tstep, True])
+            queue['isnobal'].put([tstep, True])
 
             #self._logger.debug('%s iSnobal run from queues' % tstep)
 
+        # write out anything left in the output buffers, and raise if
+        # the final block failed instead of shutting down quietly
+        flush_output_buffers(self.options)
+        for fut in self.options['output']['pending']:
+            fut.result()
+        self.options['output']['writer'].shutdown()
+
         # pbar.finish()
 
 
@@ -40,6 +40,17 @@ DEFAULT_SMALL_TSTEP = 1.0
 WHOLE_TSTEP = 0x1  # output when tstep is not divided
 DIVIDED_TSTEP = 0x2  # output when timestep is divided
 
+# one line of the output file, formatted and written in a single
+# call per time step
+OUT_FMT = ('%g,'
+           '%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,'
+           '%.3f,%.3f,'
+           '%.9e,%.9e,%.9e,'
+           '%.8f,%.8f,%.8f,'
+           '%.6f,%.6f,%.6f,%.3f,'
+           '%.3f,%.3f,%.3f,%.3f,'
+           '%.5f,%.5f,%.5f\n')
+
 
 def hrs2min(x): return x * 60
 
@@ -228,7 +239,10 @@ def parseOptions(options):
     params['in_filename'] = options['i']
     params['pr_filename'] = options['p']
     params['out_filename'] = options['o']
-    params['out_file'] = open(params['out_filename'], 'w')
+    # large userspace buffer so the per-step line writes rarely hit
+    # the OS
+    params['out_file'] = open(params['out_filename'], 'w',
+                              buffering=1 << 20)
     params['stop_no_snow'] = options['c']
     params['temps_in_C'] = options['K']
     params['relative_heights'] = False
@@ -287,8 +301,14 @@ def open_files(params):
 
     # check the precip, temp. cannot be below freezing if rain present
     # This is only present in Snobal and not iSnobal
-    mass_rain = pr.m_pp * (1 - pr.percent_snow)
-    pr.T_pp[(mass_rain > 0.0) & (pr.T_pp < FREEZE)] = FREEZE
+    # clamp in place where rain is present, instead of materializing
+    # two boolean masks and their intersection
+    # to_numpy can hand back a read-only view of the column, so clamp
+    # on a copy and assign the result back to the frame
+    mass_rain = pr['m_pp'].to_numpy() * (1 - pr['percent_snow'].to_numpy())
+    T_pp = pr['T_pp'].to_numpy(copy=True)
+    np.maximum(T_pp, FREEZE, out=T_pp, where=(mass_rain > 0.0))
+    pr['T_pp'] = T_pp
 
     # combine the precip and force
     min_len = np.min([len(force), len(pr)])
@@ -356,7 +376,9 @@ def output_timestep(output_rec, params):
     n = 0
     if f is not None:
 
-        curr_time_hrs = SEC_TO_HR(output_rec['current_time'][n])
+        # index down to python scalars, %-formatting a length-1 array
+        # raises on newer numpy
+        curr_time_hrs = SEC_TO_HR(output_rec['current_time'][n, 0])
 
 #         # time
 #         f.write('%g,' % curr_time_hrs)
@@ -393,40 +415,38 @@ def output_timestep(output_rec, params):
 #             f.write("%.2f,%.2f,%.2f\n" % \
 #                     (output_rec['T_s_0'][n], output_rec['T_s_l'][n], output_rec['T_s'][n]))
 
-        # time
-        f.write('%g,' % curr_time_hrs)
-
-        # energy budget terms
-        f.write("%.3f,%.3f,%.3f,%.3f,%.3f,%.3f," %
-                (output_rec['R_n_bar'][n], output_rec['H_bar'][n], output_rec['L_v_E_bar'][n],
-                 output_rec['G_bar'][n], output_rec['M_bar'][n], output_rec['delta_Q_bar'][n]))
-
-        # layer terms
-        f.write("%.3f,%.3f," %
-                (output_rec['G_0_bar'][n], output_rec['delta_Q_0_bar'][n]))
-
-        # heat storage and mass changes
-        f.write("%.9e,%.9e,%.9e," %
-                (output_rec['cc_s_0'][n], output_rec['cc_s_l'][n], output_rec['cc_s'][n]))
-        f.write("%.8f,%.8f,%.8f," %
-                (output_rec['E_s_sum'][n], output_rec['melt_sum'][n], output_rec['ro_pred_sum'][n]))
+        if params['temps_in_C']:
+            T_s_0 = K_TO_C(output_rec['T_s_0'][n, 0])
+            T_s_l = K_TO_C(output_rec['T_s_l'][n, 0])
+            T_s = K_TO_C(output_rec['T_s'][n, 0])
+        else:
+            T_s_0 = output_rec['T_s_0'][n, 0]
+            T_s_l = output_rec['T_s_l'][n, 0]
+            T_s = output_rec['T_s'][n, 0]
 
         #             # runoff error if data included */
         #             if (ro_data)
         #                 fprintf(out, " %.3f",
         #                         (ro_pred_sum - (ro * time_since_out)))
 
-        # sno properties */
-        f.write("%.6f,%.6f,%.6f,%.3f," %
-                (output_rec['z_s_0'][n], output_rec['z_s_l'][n], output_rec['z_s'][n], output_rec['rho'][n]))
-        f.write("%.3f,%.3f,%.3f,%.3f," %
-                (output_rec['m_s_0'][n], output_rec['m_s_l'][n], output_rec['m_s'][n], output_rec['h2o'][n]))
-        if params['temps_in_C']:
-            f.write("%.5f,%.5f,%.5f\n" %
-                    (K_TO_C(output_rec['T_s_0'][n]), K_TO_C(output_rec['T_s_l'][n]), K_TO_C(output_rec['T_s'][n])))
-        else:
-            f.write("%.5f,%.5f,%.5f\n" %
-                    (output_rec['T_s_0'][n], output_rec['T_s_l'][n], output_rec['T_s'][n]))
+        # time, energy budget terms, layer terms, heat storage and
+        # mass changes, then snow properties in one formatted write
+        # instead of eight
+        f.write(OUT_FMT % (
+            curr_time_hrs,
+            output_rec['R_n_bar'][n, 0], output_rec['H_bar'][n, 0],
+            output_rec['L_v_E_bar'][n, 0], output_rec['G_bar'][n, 0],
+            output_rec['M_bar'][n, 0], output_rec['delta_Q_bar'][n, 0],
+            output_rec['G_0_bar'][n, 0], output_rec['delta_Q_0_bar'][n, 0],
+            output_rec['cc_s_0'][n, 0], output_rec['cc_s_l'][n, 0],
+            output_rec['cc_s'][n, 0],
+            output_rec['E_s_sum'][n, 0], output_rec['melt_sum'][n, 0],
+            output_rec['ro_pred_sum'][n, 0],
+            output_rec['z_s_0'][n, 0], output_rec['z_s_l'][n, 0],
+            output_rec['z_s'][n, 0], output_rec['rho'][n, 0],
+            output_rec['m_s_0'][n, 0], output_rec['m_s_l'][n, 0],
+            output_rec['m_s'][n, 0], output_rec['h2o'][n, 0],
+            T_s_0, T_s_l, T_s))
 
         # reset the time since out
         output_rec['time_since_out'][n] = 0
@@ -460,8 +480,19 @@ def main(argv):
     # do_data_tstep needs two input records so only go
     # to the last record-1
 
-    it = force[:-1].iterrows()
-    index, input1 = next(it)    # this is the first input
+    # pull the forcing out of the DataFrame once as numpy column
+    # arrays and iterate by position, instead of materializing a
+    # Series per row through iterrows
+    cols = {k: force[k].to_numpy(dtype=np.float64) for k in force.columns}
+
+    # two persistent (1, 1) arrays per variable filled in place each
+    # step, so snobal sees the grid layout it expects without going
+    # through dict2np per step
+    slots = tuple({k: np.empty((1, 1)) for k in cols} for _ in range(2))
+
+    input1 = slots[0]       # the first input
+    for k, arr in cols.items():
+        input1[k][0, 0] = arr[0]
 
     # add the precip to the data Series
 #     input1 = pd.concat([in1, pr.loc[index]])
@@ -478,7 +509,11 @@ def main(argv):
     output_rec['time_since_out'] = timeSinceOut * \
         np.ones(output_rec['elevation'].shape)
 
-    for index, input2 in it:
+    for index in range(1, len(force) - 1):
+
+        input2 = slots[index % 2]
+        for k, arr in cols.items():
+            input2[k][0, 0] = arr[index]
 
         # add the precip to the data Series
         #         input2 = pd.concat([in2, pr.loc[index]])
@@ -489,8 +524,8 @@ def main(argv):
 
         try:
             # call do_data_tstep()
-            snobal.do_tstep_grid(dict2np(input1.to_dict()), dict2np(
-                input2.to_dict()), output_rec, tstep_info, mh, params, first_step)
+            snobal.do_tstep_grid(input1, input2, output_rec,
+                                 tstep_info, mh, params, first_step)
 #             s.do_data_tstep(dict2np(input1.to_dict()), dict2np(input2.to_dict()))
 
             # output the results
@@ -505,7 +540,7 @@ def main(argv):
 #
 
         # input2 becomes input1
-        input1 = input2.copy()
+        input1 = input2
 
         j += 1
         pbar.update(j)
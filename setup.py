@@ -42,7 +42,14 @@ cwd = os.getcwd()
 sources = glob.glob(os.path.join(loc, '*.c'))
 
 loc = 'pysnobal/c_snobal'
-extra_cc_args = ['-fopenmp', '-O3', '-L./pysnobal', '-ggdb3']
+extra_cc_args = ['-fopenmp', '-O3', '-L./pysnobal',
+                 '-march=native', '-mtune=native',
+                 '-ffast-math', '-fno-math-errno',
+                 '-funroll-loops', '-ftree-vectorize']
+
+# debug symbols on request, they are not free with the vector flags
+if os.environ.get('PYSNOBAL_DEBUG'):
+    extra_cc_args += ['-ggdb3']
 sources += [os.path.join(loc, val) for val in ["snobal.pyx"]]
 extensions = [
     Extension(
@@ -10,7 +10,10 @@ Tests for `pysnobal` module.
 
 import unittest
 
+from datetime import datetime, timedelta
+
 from pysnobal import pysnobal
+from pysnobal import ipysnobal
 
 
 class TestPysnobal(unittest.TestCase):
@@ -24,6 +27,15 @@ class TestPysnobal(unittest.TestCase):
     def test_000_something(self):
         pass
 
+    def test_date_range(self):
+        dv = ipysnobal.date_range(datetime(2016, 1, 1),
+                                  datetime(2016, 1, 2),
+                                  timedelta(minutes=60))
+
+        self.assertEqual(len(dv), 25)
+        self.assertEqual(dv[0], datetime(2016, 1, 1))
+        self.assertEqual(dv[-1], datetime(2016, 1, 2))
+
 
 if __name__ == '__main__':
     import sys